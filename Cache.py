@@ -0,0 +1,343 @@
+"""Caching helpers shared by the Model lookups."""
+
+import collections
+import contextlib
+import logging
+import pickle
+import threading
+import time
+
+from google.appengine.api import memcache
+
+
+class SingleFlight(object):
+    """
+    Coalesce concurrent calls for the same key into one in-flight fetch.
+
+    With "threadsafe: yes" an instance serves several requests at once, so a
+    cold cache would otherwise send the same Datastore query once per
+    request. The first caller for a key runs the fetch; callers arriving
+    while it is running wait for, and share, its result (or its exception).
+    If the fetch never completes, e.g. because the first caller hit its
+    request deadline (which isn't an Exception), they retry it instead.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.stats = {'calls': 0, 'fetches': 0, 'coalesced': 0, 'errors': 0}
+
+    def do(self, key, fetch):
+        """Return fetch(), sharing one call among concurrent callers of key."""
+        with self._lock:
+            self.stats['calls'] += 1
+            call = self._in_flight.get(key)
+            if call is None:
+                call = _Call()
+                self._in_flight[key] = call
+                is_leader = True
+                self.stats['fetches'] += 1
+            else:
+                is_leader = False
+                self.stats['coalesced'] += 1
+
+        if not is_leader:
+            call.done.wait()
+            if not call.completed:
+                return self.do(key, fetch)
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = fetch()
+            call.completed = True
+        except Exception as err:
+            call.error = err
+            call.completed = True
+            with self._lock:
+                self.stats['errors'] += 1
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+            call.done.set()
+
+        return call.result
+
+
+class _Call(object):
+    """One in-flight fetch, and the result it produced."""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.completed = False
+        self.result = None
+        self.error = None
+
+
+# One per instance: coalescing only helps between threads of a process.
+single_flight = SingleFlight()
+
+
+class LocalCache(object):
+    """
+    In-process stand-in for the memcache API, for tests and local runs.
+
+    Values are pickled on the way in, like memcache does, so callers never
+    share mutable objects through the cache.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def _live(self, key):
+        """Return the (expires, value) entry for key, dropping it if stale."""
+        entry = self._data.get(key)
+        if entry is not None and entry[0] and entry[0] < time.time():
+            del self._data[key]
+            entry = None
+        return entry
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key)
+        if entry is None:
+            return None
+        return pickle.loads(entry[1])
+
+    def get_multi(self, keys):
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set(self, key, value, time=0):
+        expires = _expiry(time)
+        with self._lock:
+            self._data[key] = (expires, pickle.dumps(value, -1))
+        return True
+
+    def set_multi(self, mapping, time=0):
+        """Returns the keys that were not set, which is always none."""
+        for key, value in mapping.items():
+            self.set(key, value, time)
+        return []
+
+    def add(self, key, value, time=0):
+        with self._lock:
+            if self._live(key) is not None:
+                return False
+            self._data[key] = (_expiry(time), pickle.dumps(value, -1))
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return 2 if self._data.pop(key, None) is not None else 1
+
+    def incr(self, key, delta=1, initial_value=None):
+        with self._lock:
+            entry = self._live(key)
+            if entry is None:
+                if initial_value is None:
+                    return None
+                expires, value = 0, initial_value
+            else:
+                expires, value = entry[0], pickle.loads(entry[1])
+            value += delta
+            self._data[key] = (expires, pickle.dumps(value, -1))
+        return value
+
+    def flush_all(self):
+        with self._lock:
+            self._data.clear()
+        return True
+
+
+def _expiry(seconds):
+    # Like memcache, read a time of over 30 days as a Unix timestamp
+    if seconds > MAX_RELATIVE_TIME:
+        return seconds
+    return time.time() + seconds if seconds else 0
+
+
+MAX_RELATIVE_TIME = 30 * 24 * 60 * 60
+
+
+# The catalog version, whether the catalog has settled since the last write,
+# and the memcache time to cache something fetched in that state for
+CatalogState = collections.namedtuple('CatalogState', 'version settled timeout')
+
+
+class EventCache(object):
+    """
+    Shared, cross-instance cache of Event lookups.
+
+    Entries are namespaced by a catalog version number. Any Event write bumps
+    the version, which orphans every cached lookup (including the earliest
+    and latest markers) at once; the written Events are then stored under the
+    new version, so the next read of them is a hit. Writes made inside
+    write_batch() share a single version bump.
+
+    Queries can lag a write by a few seconds, so for SETTLE_SECONDS after a
+    write the catalog is "unsettled": lookups fetched then are only cached
+    until it settles, and shouldn't be used to answer conditional requests.
+    """
+
+    VERSION_KEY = 'event_cache:version'
+    WRITTEN_KEY = 'event_cache:written_at'
+    TIMEOUT = 24 * 60 * 60
+    SETTLE_SECONDS = 60
+
+    def __init__(self, client=memcache):
+        self.client = client
+        self._local = threading.local()
+
+    def state(self):
+        """Return the CatalogState."""
+        values = self.client.get_multi([EventCache.VERSION_KEY, EventCache.WRITTEN_KEY])
+        version = values.get(EventCache.VERSION_KEY)
+        if version is None:
+            self.client.add(EventCache.VERSION_KEY, _initial_version())
+            version = self.client.get(EventCache.VERSION_KEY) or 0
+        written_at = values.get(EventCache.WRITTEN_KEY)
+        settled = written_at is None or time.time() - written_at > EventCache.SETTLE_SECONDS
+        if settled:
+            return CatalogState(version, True, EventCache.TIMEOUT)
+        # Expire when the catalog settles, however late in the window the
+        # fetch was, as an absolute time: a relative one could round to 0,
+        # which memcache reads as "never"
+        return CatalogState(version, False, int(written_at + EventCache.SETTLE_SECONDS))
+
+    def version(self):
+        return self.state()[0]
+
+    def invalidate(self):
+        """Start a new catalog version; returns it."""
+        return self.client.incr(EventCache.VERSION_KEY, initial_value=_initial_version())
+
+    def _key(self, kind, name, version=None):
+        if version is None:
+            version = self.version()
+        return u"event_cache:v{}:{}:{}".format(version, kind, name)
+
+    def get(self, kind, name, version=None):
+        """Return (hit, value); a cached None is still a hit."""
+        cached = self.client.get(self._key(kind, name, version))
+        if cached is None:
+            return False, None
+        return True, cached[0]
+
+    def set(self, kind, name, value, version=None, timeout=TIMEOUT):
+        """Cache value; returns False if memcache didn't store it."""
+        # Wrap the value so that a cached None can be told apart from a miss
+        stored = self.client.set(self._key(kind, name, version), (value,), timeout)
+        if not stored:
+            logging.warning("event cache couldn't store %s:%s", kind, name)
+        return stored
+
+    def get_many(self, kind, names, version):
+        """Return {name: value} for those of names that are cached."""
+        keys = dict((self._key(kind, name, version), name) for name in names)
+        cached = self.client.get_multi(keys.keys())
+        return dict((keys[key], value[0]) for key, value in cached.items())
+
+    def set_many(self, kind, values, version, timeout=TIMEOUT):
+        """Cache {name: value}; returns False if memcache didn't store them all."""
+        mapping = dict(
+            (self._key(kind, name, version), (value,)) for name, value in values.items())
+        not_stored = self.client.set_multi(mapping, time=timeout)
+        if not_stored:
+            logging.warning("event cache couldn't store %s of %s %s entries",
+                            len(not_stored), len(mapping), kind)
+        return not not_stored
+
+    def get_or_fetch(self, kind, name, fetch, refresh=False):
+        """
+        Return the cached value, or fetch() it once and cache the result.
+        With refresh=True, always fetch and replace the cached value.
+        """
+        version, _, timeout = self.state()
+        if not refresh:
+            hit, value = self.get(kind, name, version)
+            if hit:
+                return value
+
+        # Only the caller that runs the fetch caches its result
+        def fetch_and_set():
+            value = fetch()
+            self.set(kind, name, value, version, timeout)
+            return value
+
+        return single_flight.do((kind, name), fetch_and_set)
+
+    def written(self, event):
+        """Record a written Event (from Event._post_put_hook)."""
+        pending = getattr(self._local, 'pending', None)
+        if pending is None:
+            self.write_through([event])
+        else:
+            pending.append(event)
+
+    @contextlib.contextmanager
+    def write_batch(self):
+        """Write Events put in this block through with one version bump."""
+        if getattr(self._local, 'pending', None) is not None:
+            yield
+            return
+        self._local.pending = []
+        try:
+            yield
+        finally:
+            pending, self._local.pending = self._local.pending, None
+            if pending:
+                self.write_through(pending)
+
+    def write_through(self, events):
+        """Invalidate the catalog and cache freshly-written Events."""
+        version = self.invalidate()
+        entries = {EventCache.WRITTEN_KEY: time.time()}
+        for event in events:
+            entries[self._key('key', event.key.urlsafe(), version)] = (event,)
+            if event.short_url:
+                entries[self._key('short_url', event.short_url, version)] = (event,)
+        self.client.set_multi(entries, time=EventCache.TIMEOUT)
+
+
+class FragmentCache(object):
+    """
+    Rendered template fragments, kept per instance and keyed by template
+    name and context, for page parts that only vary with a few values.
+    """
+
+    MAX_ENTRIES = 1000
+
+    def __init__(self, render, max_entries=MAX_ENTRIES):
+        self.render = render
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._fragments = {}
+
+    def get(self, template_name, **context):
+        key = (template_name, tuple(sorted(context.items())))
+        fragment = self._fragments.get(key)
+        if fragment is None:
+            fragment = self.render(template_name, **context)
+            with self._lock:
+                # Crude bound: the keys are a handful of short_urls per page
+                if len(self._fragments) >= self.max_entries:
+                    self._fragments.clear()
+                self._fragments[key] = fragment
+        return fragment
+
+
+def _initial_version():
+    # Seed a missing (e.g. evicted) version from the clock rather than 0, so
+    # that a version number, and the ETags built on it, are never reused.
+    return int(time.time())
+
+
+event_cache = EventCache()
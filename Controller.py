@@ -1,10 +1,24 @@
 
 import csv
+import datetime
+import StringIO
+import heapq
+import itertools
+import logging
 import os
+import random
 
-from Model import Event, TimeGhost, TimeGhostError
+from google.appengine.api import datastore_errors, search, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import deferred, ndb
+
+from Cache import event_cache, single_flight
+from Model import (
+    Event, EventError, EventIndex, MigrationCheckpoint, TimeGhost, TimeGhostError
+)
 
 EVENTS_FILE = "events.csv"
+EVENT_SEARCH_INDEX = 'event_search_index'
 
 
 class EventSeeder(object):
@@ -13,19 +27,25 @@ class EventSeeder(object):
     """
 
     @classmethod
-    def seed(cls, filename=None):
-        """Add Events which don't already exist in the database."""
+    def read(cls, filename=None):
+        """Yield an unsaved Event for each row of filename."""
         if filename is None:
             dirname = os.path.dirname(__file__)
             filename = os.path.join(dirname, EVENTS_FILE)
 
-        events = []
         with open(filename) as csvfile:
             reader = csv.reader(csvfile)
             for row in reader:
                 date = row[0]
                 desc = row[1]
-                event = Event.build(date_str=date, description=desc)
+                yield Event.build(date_str=date, description=desc)
+
+    @classmethod
+    def seed(cls, filename=None):
+        """Add Events which don't already exist in the database."""
+        events = []
+        with event_cache.write_batch():
+            for event in cls.read(filename):
                 exists = Event.query(Event.description == event.description).get()
                 if not exists:
                     event.put()
@@ -34,15 +54,147 @@ class EventSeeder(object):
         return events
 
 
+class EventExport(object):
+    """The approved Events as CSV in the events.csv format, newest first."""
+
+    @classmethod
+    def build(cls, index):
+        si = StringIO.StringIO()
+        cw = csv.writer(si)
+        cw.writerows([(e.date, e.description) for e in reversed(index.events)])
+        return si.getvalue()
+
+    @classmethod
+    def get(cls):
+        """The export for the current catalog version, shared through the event cache."""
+        return event_cache.get_or_fetch(
+            'export', 'csv', lambda: cls.build(EventIndex.get()))
+
+
+class EventUploader(object):
+    """
+    Add Events from a stream of (date, description) CSV rows, such as an
+    upload of the /file export, and report what happened to each row.
+
+    Rows are read in batches, so apart from the set of descriptions already
+    seen (for catching duplicates within the upload) memory is bounded by the
+    batch size rather than the file size. Each batch is parsed and validated
+    inline: strptime is CPU-bound and holds the GIL, so a thread pool would
+    add overhead without parallelism, and App Engine standard instances
+    can't fork worker processes. New Events are then checked for existing
+    ones with the same description (as EventSeeder does) and written with a
+    single put_multi.
+    """
+
+    BATCH_SIZE = 200
+    MAX_ERRORS = 1000
+
+    @classmethod
+    def parse_row(cls, numbered_row, approved=False, created_by=None):
+        """Return (line number, Event or None, error message or None)."""
+        line, row = numbered_row
+        if isinstance(row, csv.Error):
+            return line, None, "malformed CSV row ({})".format(row)
+        if len(row) < 2:
+            return line, None, "expected 'date,description', got {!r}".format(row)
+        try:
+            description = row[1].strip().decode('utf-8')
+        except UnicodeDecodeError as err:
+            return line, None, "description isn't UTF-8 ({})".format(err)
+        if not description:
+            return line, None, "empty description"
+        try:
+            event = Event.build(
+                date_str=row[0].strip(),
+                description=description,
+                created_on=datetime.datetime.now(),
+                created_by=created_by,
+                approved=approved,
+            )
+        except (EventError, datastore_errors.BadValueError) as err:
+            # BadValueError: e.g. a description too long to index
+            return line, None, str(err)
+        return line, event, None
+
+    @classmethod
+    def numbered_rows(cls, stream):
+        """
+        Yield (line number, row) for each CSV row in stream, where the row
+        is the csv.Error for one the reader couldn't parse.
+        """
+        reader = csv.reader(stream)
+        line = 0
+        while True:
+            line += 1
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as err:
+                row = err
+            yield line, row
+
+    @classmethod
+    def upload(cls, stream, approved=False, created_by=None):
+        """Add the Events in stream; returns a report dict."""
+        report = dict(rows=0, added=0, duplicates=0, error_count=0, errors=[])
+        # The datastore check alone would miss a repeat in a later batch,
+        # as its query may not see the batches just written
+        seen = set()
+
+        rows = cls.numbered_rows(stream)
+        while True:
+            batch = list(itertools.islice(rows, cls.BATCH_SIZE))
+            if not batch:
+                break
+            report['rows'] += len(batch)
+            results = [cls.parse_row(row, approved, created_by) for row in batch]
+            cls._add_batch(results, report, seen)
+
+        logging.info("uploaded %s rows: %s added, %s duplicates, %s errors",
+                     report['rows'], report['added'], report['duplicates'],
+                     report['error_count'])
+        return report
+
+    @classmethod
+    def _add_batch(cls, results, report, seen):
+        events = []
+        for line, event, error in results:
+            if error is None:
+                events.append(event)
+            else:
+                report['error_count'] += 1
+                if len(report['errors']) < cls.MAX_ERRORS:
+                    report['errors'].append(dict(line=line, error=error))
+
+        # Check for existing Events concurrently rather than one at a time
+        existing = [
+            Event.query(Event.description == event.description).get_async()
+            for event in events
+        ]
+        new_events = []
+        for event, future in zip(events, existing):
+            if future.get_result() is not None or event.description in seen:
+                report['duplicates'] += 1
+            else:
+                seen.add(event.description)
+                new_events.append(event)
+
+        with event_cache.write_batch():
+            ndb.put_multi(new_events)
+        report['added'] += len(new_events)
+
+
 class TimeGhostFactory(object):
     """
     Create TimeGhost objects from triplets of events
     """
 
     @classmethod
-    def build(cls, now=None, middle=None, long_ago=None, get_earliest=False):
+    def build(cls, now=None, middle=None, long_ago=None, get_earliest=False, index=None):
         """
-        Create TimeGhost objects from triplets of events.
+        Create TimeGhost objects from triplets of events. Missing events are
+        picked from the datastore, or from an EventIndex if one is given.
         """
         timeghost = TimeGhost(now=now, middle=middle, long_ago=long_ago)
 
@@ -52,15 +204,342 @@ class TimeGhostFactory(object):
 
         # Generate a .middle Event if not specified:
         if timeghost.middle is None:
-            timeghost.set(Event.get_random(), "middle")
+            if index is None:
+                middle = Event.get_random(before=timeghost.now)
+            else:
+                middle = random.choice(index.before(timeghost.now.date))
+            timeghost.set(middle, "middle")
 
         # Generate a .long_ago Event if not specified:
         if timeghost.long_ago is None:
             try:
-                long_ago = timeghost.find_best_long_ago(get_earliest)
+                long_ago = timeghost.find_best_long_ago(get_earliest, index)
             except TimeGhostError:
-                long_ago = Event.get_earliest()
+                long_ago = Event.get_earliest() if index is None else index.earliest()
             timeghost.set(long_ago, "long_ago")
 
         # Return a new instance to insure the init validation is run properlhy:
         return TimeGhost(timeghost.now, timeghost.middle, timeghost.long_ago)
+
+    @classmethod
+    def timeline(cls, middle, start, end):
+        """
+        Every long_ago Event that makes a valid timeghost with middle for some
+        "now" between the start and end Events.
+
+        A long_ago event becomes valid on its timeghost.true_since date, and
+        the earlier the event, the later that date. So the events in the
+        widest window (now=end), newest first, from the event index, are a
+        sweep in order of true_since, and all of them are valid by the end of
+        the span. Returns a list of dicts, one per long_ago event, with the ratio
+        at the start (None if not yet valid) and end of the span.
+        """
+        if end.date <= middle.date:
+            raise TimeGhostError(
+                "the timeline for {} must end after it".format(middle.legendstr))
+        if end.date < start.date:
+            raise TimeGhostError("the timeline must end after it starts")
+
+        widest = TimeGhost(now=end, middle=middle)
+        earliest_date = middle.date - widest.now_td.td
+        events = EventIndex.get().between(middle.date, earliest_date)[::-1]
+
+        timeline = []
+        for long_ago in events:
+            # The window guarantees true_since <= end
+            timeghost = TimeGhost(now=end, middle=middle, long_ago=long_ago)
+            true_since = timeghost.true_since
+
+            if true_since <= start.date:
+                valid_from = start.date
+                ratio_start = TimeGhost(now=start, middle=middle, long_ago=long_ago).ratio
+            else:
+                valid_from = true_since
+                ratio_start = None
+
+            timeline.append(dict(
+                key=long_ago.short_url,
+                description=long_ago.description,
+                date=long_ago.date_ymd,
+                true_since=true_since.date().isoformat(),
+                valid_from=valid_from.date().isoformat(),
+                ratio_start=ratio_start,
+                ratio_end=timeghost.ratio,
+            ))
+        return timeline
+
+
+class TimeGhostLeaderboard(object):
+    """
+    The most surprising valid timeghosts for today: those with the ratio
+    closest to 1, i.e. the middle event only just past halfway between the
+    long_ago event and now.
+
+    A long_ago event makes a valid timeghost (ratio > 1) only if it is after
+    middle - (now - middle); the earliest such event has the smallest ratio.
+    So with the catalog sorted by date each middle needs one bisect rather
+    than a score for every pair. The k best are kept in a heap, overall and
+    per decade of the middle event.
+    """
+
+    K = 10
+    MAX_K = 100
+
+    @classmethod
+    def candidates(cls, index, now):
+        """The best timeghost for each middle event in the index."""
+        for middle in index.before(now.date):
+            long_ago = index.earliest_after(middle.date - (now.date - middle.date))
+            if long_ago is None or long_ago.date >= middle.date:
+                continue
+            yield TimeGhost(now=now, middle=middle, long_ago=long_ago)
+
+    @classmethod
+    def build(cls, index, now, k=K):
+        """
+        Return (best, by_decade): the k lowest-ratio timeghosts, and a dict of
+        decade -> the k lowest-ratio timeghosts with a middle in that decade.
+        Both are sorted best first.
+        """
+        best = []
+        by_decade = {}
+        for i, timeghost in enumerate(cls.candidates(index, now)):
+            # Max-heaps on ratio (via negation), so [0] is the one to evict;
+            # i breaks ties without comparing TimeGhosts.
+            item = (-timeghost.ratio, i, timeghost)
+            decade = timeghost.middle.date.year // 10 * 10
+            for heap in (best, by_decade.setdefault(decade, [])):
+                if len(heap) < k:
+                    heapq.heappush(heap, item)
+                elif item > heap[0]:
+                    heapq.heapreplace(heap, item)
+
+        def ranked(heap):
+            return [timeghost for _, _, timeghost in sorted(heap, reverse=True)]
+
+        return ranked(best), dict((d, ranked(h)) for d, h in by_decade.items())
+
+    @classmethod
+    def as_dict(cls, timeghost):
+        return dict(
+            factoid=timeghost.factoid,
+            permalink=timeghost.permalink_fully_qualified,
+            ratio=timeghost.ratio,
+            true_since=timeghost.true_since.date().isoformat(),
+            middle=timeghost.middle.legendstr,
+            long_ago=timeghost.long_ago.legendstr,
+        )
+
+    @classmethod
+    def sections(cls, index, now):
+        """The MAX_K best as JSON-ready dicts, under 'best' and each decade."""
+        best, by_decade = cls.build(index, now, cls.MAX_K)
+        sections = dict(
+            (str(decade), [cls.as_dict(tg) for tg in timeghosts])
+            for decade, timeghosts in by_decade.items())
+        sections['best'] = [cls.as_dict(tg) for tg in best]
+        return sections
+
+    @classmethod
+    def get(cls, k=K, decade=None, refresh=False):
+        """
+        Today's k best timeghosts as JSON-ready dicts, overall or for middle
+        events in one decade. Every section is built at MAX_K once a day
+        (and catalog version), by the daily job or else the first request,
+        and shared through the event cache one section per entry, so no
+        entry grows with the number of decades.
+        """
+        k = max(1, min(k, cls.MAX_K))
+        today = Event.today().date_ymd
+        section = 'best' if decade is None else str(decade)
+        version, _, timeout = event_cache.state()
+
+        if not refresh:
+            hit, built = event_cache.get('leaderboard', today, version)
+            if hit and section not in built:
+                return []
+            if hit:
+                name = "{}:{}".format(today, section)
+                hit, timeghosts = event_cache.get('leaderboard', name, version)
+                if hit:
+                    return timeghosts[:k]
+
+        def build_and_cache():
+            sections = cls.sections(EventIndex.get(), Event.today())
+            entries = dict(("{}:{}".format(today, name), timeghosts)
+                           for name, timeghosts in sections.items())
+            # Store the list of sections last, so that readers never see some
+            # sections missing
+            if event_cache.set_many('leaderboard', entries, version, timeout):
+                event_cache.set('leaderboard', today, sorted(sections), version, timeout)
+            return sections
+
+        sections = single_flight.do(('leaderboard', version, today), build_and_cache)
+        return sections.get(section, [])[:k]
+
+
+class TimeGhostTweets(object):
+    """
+    Today's pool of timeghosts for /tweet: one for each of up to POOL_SIZE
+    random middle events, keeping the valid ones (ratio over 1) with a
+    ratio of at most MAX_RATIO.
+    """
+
+    POOL_SIZE = 500
+    MAX_RATIO = 7  # random guess
+
+    @classmethod
+    def build(cls, index, now, size=POOL_SIZE):
+        """Return the pool as a list of TimeGhost.tweet_json strings."""
+        middles = index.before(now.date)
+        tweets = []
+        for middle in random.sample(middles, min(size, len(middles))):
+            try:
+                timeghost = TimeGhostFactory.build(now=now, middle=middle, index=index)
+            except TimeGhostError:
+                continue
+            # The fallback long_ago can be on the middle date, with no ratio
+            if timeghost.long_ago.date >= middle.date:
+                continue
+            if 1 < timeghost.ratio <= cls.MAX_RATIO:
+                tweets.append(timeghost.tweet_json)
+        return tweets
+
+    @classmethod
+    def get(cls, refresh=False):
+        """
+        The pool for today (and catalog version), built by the daily job or
+        else the first request, and shared through the event cache.
+        """
+        now = Event.today()
+        return event_cache.get_or_fetch(
+            'tweets', now.date_ymd, lambda: cls.build(EventIndex.get(), now), refresh)
+
+
+class EventMigration(object):
+    """
+    Apply a fix-up to every Event, one cursor-sized batch per task.
+
+    Subclasses set .name and override .fixup (and .save, if the fix-up
+    writes somewhere other than the Event itself). Each batch is a deferred
+    task that records its cursor in a MigrationCheckpoint before chaining
+    the next one, so a catalog of any size runs to completion without
+    hitting request timeouts, and an interrupted run can be resumed. In a
+    dry run, fixups are applied in memory and counted but nothing is saved.
+    """
+
+    name = None
+    batch_size = 100
+
+    @classmethod
+    def fixup(cls, event):
+        """Modify event in place; return True if it needs saving."""
+        raise NotImplementedError
+
+    @classmethod
+    def save(cls, events):
+        with event_cache.write_batch():
+            ndb.put_multi(events)
+
+    @classmethod
+    def start(cls, dry_run=True, restart=False):
+        """
+        Start the migration, or resume an unfinished run of it with the same
+        dry_run setting. Returns the checkpoint.
+        """
+        checkpoint = MigrationCheckpoint.get_or_insert(cls.name)
+        if restart or checkpoint.done or checkpoint.dry_run != dry_run or not checkpoint.run:
+            checkpoint.reset(dry_run)
+            checkpoint.put()
+
+        cls._enqueue(checkpoint)
+        return checkpoint
+
+    @classmethod
+    def _enqueue(cls, checkpoint):
+        # Naming tasks by run and batch keeps a double start() from forking
+        # the chain into two runs over the same cursor.
+        task_name = "migration-{}-{}-{}".format(
+            cls.name, checkpoint.run, checkpoint.batches)
+        try:
+            deferred.defer(_run_migration_batch, cls, checkpoint.run, _name=task_name)
+        except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+            logging.info("migration batch %s is already queued", task_name)
+
+    @classmethod
+    def run_batch(cls, run):
+        """Process one batch and chain the next; returns the checkpoint."""
+        checkpoint = MigrationCheckpoint.get_by_id(cls.name)
+        if checkpoint is None or checkpoint.run != run or checkpoint.done:
+            logging.info("migration %s run %s is stale, stopping", cls.name, run)
+            return checkpoint
+
+        cursor = Cursor(urlsafe=checkpoint.cursor) if checkpoint.cursor else None
+        events, next_cursor, more = Event.query().fetch_page(
+            cls.batch_size, start_cursor=cursor)
+
+        changed = [event for event in events if cls.fixup(event)]
+        if changed and not checkpoint.dry_run:
+            cls.save(changed)
+
+        checkpoint.batches += 1
+        checkpoint.processed += len(events)
+        checkpoint.changed += len(changed)
+        checkpoint.cursor = next_cursor.urlsafe() if next_cursor else None
+        checkpoint.done = not (more and next_cursor)
+        checkpoint.put()
+
+        logging.info("migration %s: %s", cls.name, checkpoint.progress)
+        if not checkpoint.done:
+            cls._enqueue(checkpoint)
+        return checkpoint
+
+
+def _run_migration_batch(migration, run):
+    """Module-level so that deferred can pickle it."""
+    migration.run_batch(run)
+
+
+class ApproveAllMigration(EventMigration):
+    """Mark every Event approved."""
+
+    name = 'approve_all'
+
+    @classmethod
+    def fixup(cls, event):
+        if event.approved:
+            return False
+        event.approved = True
+        return True
+
+
+class ShortUrlMigration(EventMigration):
+    """Recompute every Event's short_url from its description."""
+
+    name = 'addshorturl'
+
+    @classmethod
+    def fixup(cls, event):
+        short_url = event.short_url
+        event.set_short_url()
+        return event.short_url != short_url
+
+
+class SearchDocMigration(EventMigration):
+    """Add every Event's search document to the search index."""
+
+    name = 'addallsearchdocs'
+
+    @classmethod
+    def fixup(cls, event):
+        return True
+
+    @classmethod
+    def save(cls, events):
+        search.Index(EVENT_SEARCH_INDEX).put([e.search_doc for e in events])
+
+
+MIGRATIONS = dict(
+    (migration.name, migration)
+    for migration in [ApproveAllMigration, ShortUrlMigration, SearchDocMigration]
+)
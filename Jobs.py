@@ -0,0 +1,64 @@
+"""
+Scheduled jobs. cron.yaml runs the daily jobs through /tasks/daily just
+after midnight, so that the first requests of the day find the
+date-dependent caches already built.
+
+Only what is keyed by date is rebuilt here: the leaderboard and the /tweet
+pool. The event index and the /file export only change with the catalog,
+and are rebuilt on the first request after a write. /j and /timeline take
+an arbitrary middle event, so they are answered per request from the
+event index, with a per-day ETag.
+"""
+
+import logging
+import time
+
+from Controller import TimeGhostLeaderboard, TimeGhostTweets
+
+DAILY_JOBS = []
+
+
+def daily_job(job):
+    """Register job to run, in registration order, once a day."""
+    DAILY_JOBS.append(job)
+    return job
+
+
+@daily_job
+def rebuild_leaderboard():
+    TimeGhostLeaderboard.get(refresh=True)
+
+
+@daily_job
+def rebuild_tweets():
+    TimeGhostTweets.get(refresh=True)
+
+
+class JobRunner(object):
+    """Run jobs one after another, reporting on each; also usable locally."""
+
+    @classmethod
+    def run(cls, jobs=None):
+        """
+        Run jobs (default: the daily jobs). A failing job is logged and
+        reported, and doesn't stop the ones after it. Returns a list of
+        dicts with each job's name, run time and error (or None).
+        """
+        if jobs is None:
+            jobs = DAILY_JOBS
+
+        report = []
+        for job in jobs:
+            started = time.time()
+            error = None
+            try:
+                job()
+            except Exception as err:
+                logging.exception("job %s failed", job.__name__)
+                error = str(err)
+            report.append(dict(
+                job=job.__name__,
+                seconds=time.time() - started,
+                error=error,
+            ))
+        return report
@@ -1,4 +1,5 @@
 
+import bisect
 import datetime
 import json
 import logging
@@ -8,6 +9,8 @@ from string import ascii_letters, digits
 from google.appengine.api import search
 from google.appengine.ext import ndb
 
+from Cache import event_cache, single_flight
+
 class TimeGhostError(ValueError):
     """ Error class for TimeGhost actions.  """
     pass
@@ -93,10 +96,13 @@ class Event(ndb.Model):
         is a date, create a non-datastore Event from that date.
         """
         try:
-            event = ndb.Key(urlsafe=kod).get()
+            key = ndb.Key(urlsafe=kod)
+            event = event_cache.get_or_fetch('key', kod, key.get)
         except Exception as err: # TODO: specific exception for key not found
             # Try matching 'kod' to short_url, construct a temp Event otherwise
-            event = Event.query().filter(Event.short_url == kod).get()
+            event = event_cache.get_or_fetch(
+                'short_url', kod,
+                Event.query().filter(Event.short_url == kod).get)
             if event is None:
                 event = Event.build(date_str=kod, description=description)
 
@@ -112,6 +118,14 @@ class Event(ndb.Model):
         event.set_short_url()
         return event
 
+    @classmethod
+    def today(cls):
+        """Like Event.now(), but at midnight, so it is stable for the whole day."""
+        today = datetime.datetime.combine(datetime.date.today(), datetime.time())
+        event = Event(date=today, description="today")
+        event.set_short_url()
+        return event
+
     @classmethod
     def approved_query(cls):
         query = Event.query().filter(Event.approved == True)
@@ -129,31 +143,37 @@ class Event(ndb.Model):
     @classmethod
     def get_random(cls, before=None):
         """Inputs: before - an Event """
-        earliest = Event.get_earliest()
-        events = Event.between_query(before.date, earliest.date).fetch()
+        index = EventIndex.get()
+        events = index.between(before.date, index.earliest().date)
         event = random.choice(events)
         return event
 
     @classmethod
     def get_latest(cls):
-        event = Event.approved_query().order(-Event.date).get()
+        query = Event.approved_query().order(-Event.date)
+        event = event_cache.get_or_fetch('marker', 'latest', query.get)
         return event
 
     @classmethod
     def get_earliest(cls):
-        event = Event.approved_query().order(Event.date).get()
+        query = Event.approved_query().order(Event.date)
+        event = event_cache.get_or_fetch('marker', 'earliest', query.get)
         return event
 
     @classmethod
-    def get_events_in_range(cls, now, middle_kod, sort_asc=True):
+    def get_events_in_range(cls, now, middle_kod, sort_asc=True, index=None):
         """
         Get the Events that are valid timeghost.long_ago events for
-        middle=middle and now=now.
+        middle=middle and now=now, from the datastore or an EventIndex.
         """
         event = Event.get_from_key_or_date(middle_kod)
         timeghost = TimeGhost(now=now, middle=event)
         earliest_date = event.date - timeghost.now_td.td
 
+        if index is not None:
+            events = index.between(event.date, earliest_date)
+            return events[::-1] if sort_asc else events
+
         query = Event.between_query(event.date, earliest_date)
         if sort_asc:
             query = query.order(-Event.date)
@@ -177,6 +197,15 @@ class Event(ndb.Model):
             events = Event.approved_query().order(-Event.date).fetch()
         return events
 
+    def _post_put_hook(self, future):
+        """Write every successful put through to the shared event cache."""
+        if future.get_exception() is None:
+            event_cache.written(self)
+
+    @classmethod
+    def _post_delete_hook(cls, key, future):
+        event_cache.write_through([])
+
     def __sub__(self, other):
         """Return the timedelta between two Events' .date attributes."""
         return self.date - other.date
@@ -218,9 +247,212 @@ class Event(ndb.Model):
         return self.date.isoformat().strip().split("T")[0]
 
 
+class EventIndex(object):
+    """
+    Approved Events sorted by date, for range lookups without a query per
+    lookup.
+    """
+
+    # Rows per memcache value; a row is ~200 bytes, and memcache won't store
+    # a value over 1MB
+    SHARD_SIZE = 1000
+
+    # This instance's copy of the current index, as (catalog version, index)
+    _instance_copy = (None, None)
+
+    def __init__(self, events):
+        self.events = sorted(events, key=lambda e: e.date)
+        self.dates = [e.date for e in self.events]
+
+    @classmethod
+    def load(cls):
+        return cls(Event.approved_query().order(Event.date).fetch())
+
+    @classmethod
+    def get(cls):
+        """
+        The index for the current catalog version. It is kept per instance,
+        and shared between instances through the event cache as shards of
+        compact rows. If memcache won't store it, each instance still loads
+        it only once per catalog version.
+        """
+        version, settled, timeout = event_cache.state()
+        copy_version, index = cls._instance_copy
+        if copy_version != version:
+            index = cls._from_cache(version, settled)
+
+        if index is None:
+            def load_and_cache():
+                index = cls.load()
+                cls._to_cache(index, version, settled, timeout)
+                return index
+
+            # Keyed by settled too, so that a caller after the settle window
+            # never shares a load from inside it
+            index = single_flight.do(('index', version, settled), load_and_cache)
+
+        # Only hold on to an index built after the settle window, as one
+        # built in it may be missing the write
+        if settled:
+            cls._instance_copy = (version, index)
+        return index
+
+    @classmethod
+    def _to_cache(cls, index, version, settled, timeout):
+        rows = index.rows()
+        shards = dict(
+            (str(i), rows[start:start + cls.SHARD_SIZE])
+            for i, start in enumerate(range(0, len(rows), cls.SHARD_SIZE)))
+        # Store the shard count last, so that readers never see a partial index
+        if event_cache.set_many('index_shard', shards, version, timeout):
+            event_cache.set('index', 'approved', (len(shards), settled), version, timeout)
+
+    @classmethod
+    def _from_cache(cls, version, settled):
+        hit, header = event_cache.get('index', 'approved', version)
+        if not hit:
+            return None
+        count, built_settled = header
+        if settled and not built_settled:
+            return None
+        names = [str(i) for i in range(count)]
+        shards = event_cache.get_many('index_shard', names, version)
+        if len(shards) != count:
+            return None
+        rows = []
+        for name in names:
+            rows.extend(shards[name])
+        return cls.from_rows(rows)
+
+    def rows(self):
+        """The events as compact (date, short_url, description, key) tuples."""
+        return [
+            (e.date, e.short_url, e.description, e.key.urlsafe() if e.key else None)
+            for e in self.events
+        ]
+
+    @classmethod
+    def from_rows(cls, rows):
+        return cls([
+            Event(
+                key=ndb.Key(urlsafe=key) if key else None,
+                date=date,
+                short_url=short_url,
+                description=description,
+                approved=True,
+            )
+            for date, short_url, description, key in rows
+        ])
+
+    def __len__(self):
+        return len(self.events)
+
+    def before(self, date):
+        """Events strictly earlier than date, oldest first."""
+        return self.events[:bisect.bisect_left(self.dates, date)]
+
+    def between(self, earlier_than, later_than):
+        """Like Event.between_query: events strictly between two dates, oldest first."""
+        lo = bisect.bisect_right(self.dates, later_than)
+        hi = bisect.bisect_left(self.dates, earlier_than)
+        return self.events[lo:hi]
+
+    def earliest(self):
+        return self.events[0] if self.events else None
+
+    def find(self, short_url):
+        """The event with this short_url, or None."""
+        for event in self.events:
+            if event.short_url == short_url:
+                return event
+        return None
+
+    def earliest_after(self, date):
+        """The earliest event strictly later than date, or None."""
+        i = bisect.bisect_right(self.dates, date)
+        if i == len(self.events):
+            return None
+        return self.events[i]
+
+
+class MigrationCheckpoint(ndb.Model):
+    """
+    Progress of a batched Event migration, keyed by the migration's name.
+    The cursor lets a migration resume where its last batch left off.
+    """
+    run = ndb.IntegerProperty(default=0)
+    cursor = ndb.StringProperty()
+    dry_run = ndb.BooleanProperty(default=True)
+    batches = ndb.IntegerProperty(default=0)
+    processed = ndb.IntegerProperty(default=0)
+    changed = ndb.IntegerProperty(default=0)
+    done = ndb.BooleanProperty(default=False)
+    started_on = ndb.DateTimeProperty()
+    updated_on = ndb.DateTimeProperty(auto_now=True)
+
+    def reset(self, dry_run):
+        self.run += 1
+        self.cursor = None
+        self.dry_run = dry_run
+        self.batches = 0
+        self.processed = 0
+        self.changed = 0
+        self.done = False
+        self.started_on = datetime.datetime.now()
+
+    @property
+    def progress(self):
+        return dict(
+            name=self.key.id(),
+            run=self.run,
+            dry_run=self.dry_run,
+            batches=self.batches,
+            processed=self.processed,
+            changed=self.changed,
+            done=self.done,
+            started_on=str(self.started_on),
+            updated_on=str(self.updated_on),
+        )
+
+
+class RequestProfile(ndb.Model):
+    """cProfile output for one profiled request."""
+    path = ndb.StringProperty()
+    created_on = ndb.DateTimeProperty(auto_now_add=True)
+    duration = ndb.FloatProperty()
+    stats_text = ndb.TextProperty()
+    stats_raw = ndb.BlobProperty(compressed=True)
+
+    @classmethod
+    def recent(cls, limit=50):
+        return cls.query().order(-cls.created_on).fetch(limit)
+
+
+class memoized_property(object):
+    """
+    A read-only property that is computed once per instance and kept in the
+    instance's ._memo dict; clearing ._memo forces a recompute.
+    """
+
+    def __init__(self, fget):
+        self.fget = fget
+        self.name = fget.__name__
+        self.__doc__ = fget.__doc__
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        try:
+            return obj._memo[self.name]
+        except KeyError:
+            value = obj._memo[self.name] = self.fget(obj)
+            return value
+
+
 class TimeGhostDelta(object):
     def __init__(self, beginning, ending):
         self.td = beginning.date - ending.date
+        self._memo = {}
 
     def verbose_between(self, other):
         """
@@ -274,19 +506,19 @@ class TimeGhostDelta(object):
 
         return txt
 
-    @property
+    @memoized_property
     def years(self):
         return float(self.td.days) / DAYS_IN_YEAR
 
-    @property
+    @memoized_property
     def years_int(self):
         return int(self.years)
 
-    @property
+    @memoized_property
     def days(self):
         return DAYS_IN_YEAR * (self.years - self.years_int)
 
-    @property
+    @memoized_property
     def days_int(self):
         return int(self.days)
 
@@ -309,6 +541,7 @@ class TimeGhost(object):
 
     def _make_tds(self):
         """time deltas for now->middle and middle->long ago"""
+        self._memo = {}
         if self.now and self.middle:
             self.now_td = TimeGhostDelta(self.now, self.middle)
         if self.middle and self.long_ago:
@@ -316,6 +549,7 @@ class TimeGhost(object):
 
 
     def __init__(self, now=None, middle=None, long_ago=None, display_prefix="The "):
+        self._memo = {}
         self.now = now
         self.middle = middle
         self.long_ago = long_ago
@@ -324,6 +558,16 @@ class TimeGhost(object):
         self._validate_event_ordering()
         self._make_tds()
 
+    @property
+    def display_prefix(self):
+        return self._display_prefix
+
+    @display_prefix.setter
+    def display_prefix(self, display_prefix):
+        # The factoid and verbose text depend on the prefix
+        self._display_prefix = display_prefix
+        self._memo = {}
+
     def set(self, event, which_event):
         """
         Inputs: an Event object and a string of "now" "middle" or "long_ago"
@@ -345,24 +589,37 @@ class TimeGhost(object):
         timedelta = datetime.timedelta(days=upper_edge)
         return timedelta
 
-    def find_best_long_ago(self, get_earliest=False):
-        """Return the best long_ago event based on self.middle and self.now."""
+    def find_best_long_ago(self, get_earliest=False, index=None):
+        """
+        Return the best long_ago event based on self.middle and self.now.
+        Candidates come from the datastore, or from an EventIndex if given.
+        """
 
         wanted_date_earliest = self.middle.date - self.now_td.td
         wanted_date_latest = self.middle.date - self.scaled_timedelta(TimeGhost.TIME_RANGE)
 
-        events = Event.between_query(self.middle.date, wanted_date_earliest).order(Event.date)
+        if index is None:
+            events = Event.between_query(self.middle.date, wanted_date_earliest).order(Event.date)
+            fetch_good_range = events.filter(Event.date < wanted_date_latest).fetch
+            fetch_all = events.fetch
+            get_earliest_event = Event.get_earliest
+        else:
+            events = index.between(self.middle.date, wanted_date_earliest)
+            fetch_good_range = lambda: [e for e in events if e.date < wanted_date_latest]
+            fetch_all = lambda: events
+            get_earliest_event = index.earliest
+
         try:
-            good_range_events = events.filter(Event.date < wanted_date_latest).fetch()
+            good_range_events = fetch_good_range()
             if get_earliest:
                 event = good_range_events[0]
             else:
                 event = random.choice(good_range_events)
         except IndexError:
             try:
-                event = random.choice(events.fetch())
+                event = random.choice(fetch_all())
             except IndexError as err:
-                event = Event.get_earliest()
+                event = get_earliest_event()
         except:
             raise TimeGhostError(
                 "can't find an event between {} and {}".format(
@@ -397,20 +654,20 @@ class TimeGhost(object):
                           which)
             return event.date.year
 
-    @property
+    @memoized_property
     def permalink(self):
         return "/p/{}/{}".format(self.key_url('middle'), self.key_url('long_ago'))
 
-    @property
+    @memoized_property
     def permalink_fully_qualified(self):
         return "https://timeg.host{}".format(self.permalink)
 
-    @property
+    @memoized_property
     def true_since(self):
         """The date that this timeghost first was true."""
         return self.middle.date + self.then_td.td
 
-    @property
+    @memoized_property
     def factoid_list(self):
         return [
             s.encode("utf-8")
@@ -422,7 +679,7 @@ class TimeGhost(object):
             ]
         ]
 
-    @property
+    @memoized_property
     def factoid(self):
         try:
             output = "{}{} is closer to the {} than {}".format(*self.factoid_list)
@@ -430,7 +687,7 @@ class TimeGhost(object):
             output = "This timeghost is incomplete ({})".format(err)
         return output
 
-    @property
+    @memoized_property
     def verbose(self):
         if self.middle.description == "Your birthday":
             middle = "The day of your birth is "
@@ -467,7 +724,7 @@ class TimeGhost(object):
     middle: {0.middle};
     long_ago: {0.long_ago}""".format(self)
 
-    @property
+    @memoized_property
     def ratio(self):
         """
         Ratio of (now - middle) / (middle - long_ago)
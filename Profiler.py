@@ -0,0 +1,80 @@
+"""Opt-in, rate-limited profiling of single requests."""
+
+import cProfile
+import logging
+import marshal
+import pstats
+import StringIO
+import threading
+import time
+
+from google.appengine.api import users
+
+from Model import RequestProfile
+
+PROFILE_HEADER = 'X-Timeghost-Profile'
+PROFILE_ARG = 'profile'
+
+
+class RequestProfiler(object):
+    """
+    Run a request under cProfile when an admin asks for it with the
+    X-Timeghost-Profile header or a ?profile=1 query flag, and store the
+    stats as a RequestProfile.
+
+    At most one request per MIN_INTERVAL seconds is profiled on each
+    instance, so leaving this enabled in production is safe.
+    """
+
+    MIN_INTERVAL = 60
+    STATS_LINES = 60
+
+    def __init__(self, min_interval=MIN_INTERVAL):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._last_started = None
+
+    def wanted(self, request):
+        """Is profiling this request asked for, allowed, and within the rate limit?"""
+        asked = (request.headers.get(PROFILE_HEADER) == '1' or
+                 request.args.get(PROFILE_ARG) == '1')
+        if not asked or not users.is_current_user_admin():
+            return False
+        return self._take_slot()
+
+    def _take_slot(self):
+        with self._lock:
+            now = time.time()
+            if self._last_started is not None and now - self._last_started < self.min_interval:
+                logging.info("profiling skipped: rate limited")
+                return False
+            self._last_started = now
+            return True
+
+    def start(self):
+        profile = cProfile.Profile()
+        profile.enable()
+        return profile
+
+    def finish(self, profile, path, started):
+        """Stop profile and store its stats; returns the RequestProfile."""
+        profile.disable()
+        duration = time.time() - started
+
+        profile.create_stats()
+        text = StringIO.StringIO()
+        stats = pstats.Stats(profile, stream=text)
+        stats.sort_stats('cumulative').print_stats(RequestProfiler.STATS_LINES)
+
+        request_profile = RequestProfile(
+            path=path,
+            duration=duration,
+            stats_text=text.getvalue(),
+            stats_raw=marshal.dumps(profile.stats),
+        )
+        request_profile.put()
+        logging.info("profiled %s in %.3fs", path, duration)
+        return request_profile
+
+
+request_profiler = RequestProfiler()
@@ -0,0 +1,15 @@
+"""Helpers shared by bench_render.py and loadtest.py."""
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def import_app():
+    """
+    Import and return the app's main module. Call it only once the testbed
+    is up, as main sets up the memcache-backed template bytecode cache.
+    """
+    import main
+    return main
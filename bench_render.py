@@ -0,0 +1,68 @@
+"""
+Measure the CPU cost of rendering timeghost.html.
+
+Builds timeghosts from events.csv in memory (no datastore) and renders each
+one with the app's Jinja environment, inside an App Engine testbed for the
+memcache-backed bytecode cache. Needs the App Engine SDK and the app's
+libraries on PYTHONPATH.
+
+    python bench_render.py --renders 2000 > bench_output.txt
+"""
+
+import argparse
+import random
+import time
+
+from flask import render_template
+from google.appengine.ext import testbed
+
+from bench_common import import_app, percentile
+from Controller import EventSeeder, TimeGhostFactory
+from Model import Event, EventIndex
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time timeghost.html renders")
+    parser.add_argument('--renders', type=int, default=1000)
+    parser.add_argument('--seed', type=int, default=1)
+    options = parser.parse_args(argv)
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_memcache_stub()
+
+    timeghost_main = import_app()
+
+    random.seed(options.seed)
+    index = EventIndex(EventSeeder.read())
+    now = Event.today()
+    # Python 2's strftime, used by timeghost.html, can't format years before
+    # 1900. true_since is never before the middle date, so skipping middles
+    # before 1900 is enough
+    middles = [e for e in index.before(now.date) if e.date.year >= 1900]
+
+    app = timeghost_main.app
+    timings = []
+    with app.test_request_context('/'):
+        # The first render compiles (or loads) the templates; don't count it
+        render_template('timeghost.html', timeghost=TimeGhostFactory.build(
+            now=now, middle=middles[-1], index=index))
+
+        for _ in range(options.renders):
+            timeghost = TimeGhostFactory.build(
+                now=now, middle=random.choice(middles), index=index)
+            started = time.clock()
+            render_template('timeghost.html', timeghost=timeghost)
+            timings.append(time.clock() - started)
+
+    bed.deactivate()
+
+    print("renders: {}".format(len(timings)))
+    print("cpu per render, mean: {:.1f} us".format(1e6 * sum(timings) / len(timings)))
+    for fraction in (0.5, 0.95, 0.99):
+        print("cpu per render, p{:.0f}: {:.1f} us".format(
+            100 * fraction, 1e6 * percentile(timings, fraction)))
+
+
+if __name__ == '__main__':
+    main()
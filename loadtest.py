@@ -0,0 +1,270 @@
+"""
+Replay a request mix against main.app and report capacity numbers.
+
+Runs the app in-process on App Engine testbed stubs (datastore seeded from
+events.csv, memcache, users, mail, search, task queue), with a pool of
+threads to match "threadsafe: yes". Requests come from an access log
+(common/combined format, or one path per line) or from a synthetic mix of
+/, /b/<date> and /p/<middle>/<long_ago>. Reports throughput, a latency
+histogram and Datastore/memcache calls per request for each route, and
+saves the results as JSON for comparing across commits. Needs the App
+Engine SDK and the app's libraries on PYTHONPATH.
+
+    python loadtest.py --requests 2000 --threads 8
+    python loadtest.py --log access.log --compare loadtest_results/abc1234.json
+"""
+
+import argparse
+import collections
+import json
+import os
+import Queue
+import random
+import re
+import subprocess
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb, testbed
+
+from bench_common import import_app, percentile
+
+# Upper edges of the latency histogram buckets, in milliseconds
+BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, float('inf')]
+
+LOG_PATH_RE = re.compile(r'"(?:GET|POST|HEAD) (\S+)')
+
+_calls = threading.local()
+
+
+def _count_call(service, call, request, response):
+    counts = getattr(_calls, 'counts', None)
+    if counts is not None:
+        counts[service] += 1
+
+
+def set_up_testbed():
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.setup_env(USER_EMAIL='', USER_ID='', USER_IS_ADMIN='0', overwrite=True)
+    policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(probability=1)
+    bed.init_datastore_v3_stub(consistency_policy=policy)
+    bed.init_memcache_stub()
+    bed.init_user_stub()
+    bed.init_mail_stub()
+    bed.init_search_stub()
+    bed.init_taskqueue_stub(root_path=os.path.dirname(os.path.abspath(__file__)))
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'loadtest_call_counter', _count_call)
+    return bed
+
+
+def seed_events():
+    from Cache import EventCache, event_cache
+    from Controller import EventSeeder
+    events = list(EventSeeder.read())
+    for event in events:
+        event.approved = True
+    with event_cache.write_batch():
+        ndb.put_multi(events)
+    # Measure the steady state between writes, not the settle window after one
+    event_cache.client.set(
+        EventCache.WRITTEN_KEY, time.time() - EventCache.SETTLE_SECONDS - 1)
+    return events
+
+
+def paths_from_log(filename):
+    paths = []
+    with open(filename) as log:
+        for line in log:
+            match = LOG_PATH_RE.search(line)
+            if match:
+                paths.append(match.group(1))
+            elif line.startswith('/'):
+                paths.append(line.strip())
+    return paths
+
+
+def synthetic_paths(events, count):
+    """A mix of random timeghosts, birthdays and permalinks."""
+    paths = []
+    for _ in range(count):
+        kind = random.random()
+        if kind < 0.5:
+            paths.append('/')
+        elif kind < 0.75:
+            paths.append('/b/{}'.format(random.randint(1940, 2015)))
+        else:
+            middle, long_ago = sorted(random.sample(events, 2), key=lambda e: e.date)[::-1]
+            paths.append('/p/{}/{}'.format(middle.short_url, long_ago.short_url))
+    return paths
+
+
+def route_for(adapter, path):
+    try:
+        endpoint, _ = adapter.match(path.split('?')[0])
+    except Exception:
+        endpoint = 'unrouted'
+    return endpoint
+
+
+def run(app, paths, threads):
+    """Issue every path from a pool of threads; returns per-request records."""
+    from Cache import event_cache
+    adapter = app.url_map.bind('localhost')
+    work = Queue.Queue()
+    for path in paths:
+        work.put(path)
+    records = []
+    records_lock = threading.Lock()
+
+    def worker():
+        client = app.test_client()
+        while True:
+            try:
+                path = work.get_nowait()
+            except Queue.Empty:
+                return
+            # Like App Engine, start every request with a fresh ndb context cache
+            ndb.get_context().clear_cache()
+            _calls.counts = collections.Counter()
+            started = time.time()
+            try:
+                status = client.get(path).status_code
+            except Exception:
+                # The test client re-raises the app's exceptions; count them
+                # as the 500s they would be, rather than losing the thread
+                status = 500
+            elapsed = time.time() - started
+            record = dict(
+                route=route_for(adapter, path),
+                status=status,
+                seconds=elapsed,
+                datastore_calls=_calls.counts['datastore_v3'],
+                memcache_calls=_calls.counts['memcache'],
+            )
+            _calls.counts = None
+            with records_lock:
+                records.append(record)
+
+    event_cache.version()  # create the version key before the threads race for it
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.time()
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return records, time.time() - started
+
+
+def summarize(records, wall_seconds):
+    by_route = collections.defaultdict(list)
+    for record in records:
+        by_route[record['route']].append(record)
+    by_route['ALL'] = records
+
+    summary = {}
+    for route, route_records in by_route.items():
+        latencies_ms = [1000 * r['seconds'] for r in route_records]
+        histogram = collections.OrderedDict((str(edge), 0) for edge in BUCKETS_MS)
+        for latency in latencies_ms:
+            edge = next(edge for edge in BUCKETS_MS if latency <= edge)
+            histogram[str(edge)] += 1
+        count = float(len(route_records))
+        summary[route] = dict(
+            requests=len(route_records),
+            errors=sum(1 for r in route_records if r['status'] >= 500),
+            rps=len(route_records) / wall_seconds,
+            p50_ms=percentile(latencies_ms, 0.5),
+            p95_ms=percentile(latencies_ms, 0.95),
+            p99_ms=percentile(latencies_ms, 0.99),
+            datastore_calls_per_request=sum(r['datastore_calls'] for r in route_records) / count,
+            memcache_calls_per_request=sum(r['memcache_calls'] for r in route_records) / count,
+            histogram_ms=histogram,
+        )
+    return summary
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def print_summary(summary, baseline=None):
+    print("{:<32} {:>7} {:>8} {:>8} {:>8} {:>8} {:>7} {:>7}".format(
+        'route', 'reqs', 'rps', 'p50 ms', 'p95 ms', 'p99 ms', 'ds/req', 'mc/req'))
+    for route in sorted(summary):
+        stats = summary[route]
+        print("{:<32} {requests:>7} {rps:>8.1f} {p50_ms:>8.1f} {p95_ms:>8.1f} "
+              "{p99_ms:>8.1f} {datastore_calls_per_request:>7.2f} "
+              "{memcache_calls_per_request:>7.2f}".format(route, **stats))
+        old = baseline.get(route) if baseline else None
+        if old:
+            print("{:<32} {:>7} {:>+8.1f} {:>8} {:>+8.1f} {:>8} {:>+7.2f}".format(
+                '  vs baseline', '',
+                stats['rps'] - old['rps'], '',
+                stats['p95_ms'] - old['p95_ms'], '',
+                stats['datastore_calls_per_request'] - old['datastore_calls_per_request']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Load test main.app in-process")
+    parser.add_argument('--log', help="access log to replay (default: a synthetic mix)")
+    parser.add_argument('--requests', type=int, default=1000,
+                        help="number of synthetic requests, or the cap on replayed ones")
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="results file (default: loadtest_results/<commit>.json)")
+    parser.add_argument('--compare', help="earlier results file to compare against")
+    options = parser.parse_args(argv)
+
+    random.seed(options.seed)
+    bed = set_up_testbed()
+    try:
+        timeghost_main = import_app()
+        events = seed_events()
+        if options.log:
+            paths = paths_from_log(options.log)[:options.requests]
+        else:
+            paths = synthetic_paths(events, options.requests)
+
+        records, wall_seconds = run(timeghost_main.app, paths, options.threads)
+    finally:
+        bed.deactivate()
+
+    commit = git_commit()
+    results = dict(
+        commit=commit,
+        created_on=time.strftime('%Y-%m-%d %H:%M:%S'),
+        threads=options.threads,
+        requests=len(records),
+        wall_seconds=wall_seconds,
+        source=options.log or 'synthetic',
+        routes=summarize(records, wall_seconds),
+    )
+
+    output = options.output
+    if output is None:
+        output = os.path.join('loadtest_results', '{}.json'.format(commit))
+    if os.path.dirname(output) and not os.path.isdir(os.path.dirname(output)):
+        os.makedirs(os.path.dirname(output))
+    with open(output, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+
+    baseline = None
+    if options.compare:
+        with open(options.compare) as baseline_file:
+            baseline = json.load(baseline_file)['routes']
+
+    print("{} requests, {} threads, {:.1f}s, commit {}".format(
+        len(records), options.threads, wall_seconds, commit))
+    print_summary(results['routes'], baseline)
+    print("saved to {}".format(output))
+
+
+if __name__ == '__main__':
+    main()
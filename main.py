@@ -1,21 +1,134 @@
 """Main program for timeghost."""
 
-from flask import Flask, render_template, request, make_response
-from google.appengine.api import mail, search, users
+from flask import Flask, g, render_template, request, make_response
+from google.appengine.api import mail, memcache, search, users
+from jinja2 import Markup, MemcachedBytecodeCache
 import logging
 import datetime
+import functools
+import hashlib
+import random
+import time
 import json
-import StringIO
-import csv
-
-from Controller import EventSeeder, TimeGhostFactory, EVENTS_FILE
-from Model import Event, TimeGhost, TimeGhostError
-
-EVENT_SEARCH_INDEX = 'event_search_index'
+import zlib
+
+from Cache import FragmentCache, event_cache, single_flight
+from Controller import (
+    EventExport, EventSeeder, EventUploader, TimeGhostFactory, TimeGhostLeaderboard,
+    TimeGhostTweets,
+    EVENTS_FILE, EVENT_SEARCH_INDEX, MIGRATIONS,
+    ApproveAllMigration, SearchDocMigration, ShortUrlMigration,
+)
+from Jobs import JobRunner
+from Model import (
+    Event, EventIndex, MigrationCheckpoint, RequestProfile, TimeGhost, TimeGhostError
+)
+from Profiler import request_profiler
 
 app = Flask(__name__)
 app.config['DEBUG'] = True
 
+# Share compiled templates between instances, so a new instance doesn't
+# recompile every template on its first requests.
+app.jinja_env.bytecode_cache = MemcachedBytecodeCache(memcache, prefix='jinja2/bytecode/')
+
+fragment_cache = FragmentCache(
+    lambda template_name, **context: Markup(render_template(template_name, **context)))
+app.jinja_env.globals['fragment'] = fragment_cache.get
+
+@app.before_request
+def start_profiling():
+    if request_profiler.wanted(request):
+        g.profile_started = time.time()
+        g.profile = request_profiler.start()
+
+@app.after_request
+def finish_profiling(response):
+    profile = getattr(g, 'profile', None)
+    if profile is not None:
+        g.profile = None
+        request_profile = request_profiler.finish(
+            profile, request.full_path, g.profile_started)
+        response.headers['X-Timeghost-Profile-Id'] = str(request_profile.key.id())
+    return response
+
+@app.teardown_request
+def abandon_profiling(exc):
+    # A request that raised never reached finish_profiling; don't leave the
+    # profiler running on this thread.
+    profile = getattr(g, 'profile', None)
+    if profile is not None:
+        profile.disable()
+
+# Bodies smaller than this aren't worth compressing
+MIN_COMPRESS_SIZE = 512
+
+def negotiated_encoding():
+    """'gzip', 'deflate' or None, from the request's Accept-Encoding."""
+    return request.accept_encodings.best_match(['gzip', 'deflate'])
+
+def compress(data, encoding):
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    return zlib.compress(data, 6)
+
+def catalog_etag(version):
+    """
+    A strong ETag for the current request. It changes whenever an Event is
+    written (the event cache's catalog version), at midnight (responses
+    depend on "now"), and with the request path and content encoding.
+    """
+    parts = [
+        version,
+        datetime.date.today().isoformat(),
+        request.full_path,
+        negotiated_encoding(),
+    ]
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+def compressed(view):
+    """Gzip or deflate the view's response if the client accepts it."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        response = make_response(view(*args, **kwargs))
+        response.headers['Vary'] = 'Accept-Encoding'
+
+        encoding = negotiated_encoding()
+        if (encoding is None or response.status_code != 200 or
+                'Content-Encoding' in response.headers or
+                len(response.data) < MIN_COMPRESS_SIZE):
+            return response
+
+        response.data = compress(response.data, encoding)
+        response.headers['Content-Encoding'] = encoding
+        return response
+    return wrapper
+
+def conditional(view):
+    """
+    Answer a GET with 304 Not Modified, without running the view, if the
+    client already has the current catalog_etag. Just after a write the
+    catalog's queries may not show it yet, so no ETag is given then.
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        version, settled, _ = event_cache.state()
+        if request.method not in ('GET', 'HEAD') or not settled:
+            return view(*args, **kwargs)
+
+        etag = catalog_etag(version)
+        if etag in request.if_none_match:
+            response = make_response(('', 304))
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        response.headers['Vary'] = 'Accept-Encoding'
+        return response
+    return wrapper
+
 # TODO: finish
 @app.route('/search')
 def event_search():
@@ -38,18 +151,20 @@ def event_search():
 
     return("HI")
 
+def start_migration(name):
+    """
+    Start (or resume) the named batched Event migration. Runs dry unless the
+    request has ?live=1; ?restart=1 discards any unfinished run's progress.
+    """
+    migration = MIGRATIONS[name]
+    dry_run = request.args.get('live') != '1'
+    restart = request.args.get('restart') == '1'
+    checkpoint = migration.start(dry_run=dry_run, restart=restart)
+    return json.dumps(checkpoint.progress)
+
 @app.route('/addallsearchdocs')
 def add_all_search_docs():
-    event_search_index = search.Index(EVENT_SEARCH_INDEX)
-    events = Event.query().fetch()
-    count = 0
-    for event in events:
-        count += 1
-        doc = event.search_doc
-        event_search_index.put(doc)
-        #event.put() # TODO Uncomment to go live
-    title = "Updated {} events to add search doc".format(count)
-    return render_template('events.html', events=events, title=title)
+    return start_migration(SearchDocMigration.name)
 
 @app.route('/raves')
 def show_testimonials():
@@ -57,31 +172,18 @@ def show_testimonials():
 
 @app.route('/addshorturl')
 def addshorturl():
-    #user = users.get_current_user()
-    #now = datetime.datetime.now()
-
-    #events = Event.query().filter(Event.created_by == None).fetch()
-    #events = Event.query().filter(Event.short_url == None).fetch()
-    events = Event.query().fetch()
-    count = 0
-    for event in events:
-        count += 1
-        #event.created_on = now
-        #event.created_by = user
-        #event.approved = True
-        event.set_short_url()
-        #event.put() # TODO Uncomment to go live
-    title = "Updated %s events to add a short_url" % count
-    return render_template('events.html', events=events, title=title)
+    return start_migration(ShortUrlMigration.name)
 
 # Approve all # TODO remove this
 @app.route('/approve_all', methods=['POST', 'GET'])
 def approve_all():
-    events = Event.query().fetch()
-    for event in events:
-        event.approved = True
-        event.put()
-    return "HI"
+    return start_migration(ApproveAllMigration.name)
+
+# Progress of the batched migrations
+@app.route('/migrations')
+def migrations_server():
+    checkpoints = MigrationCheckpoint.query().fetch()
+    return json.dumps({'migrations': [c.progress for c in checkpoints]})
 
 # Add a single new event:
 @app.route('/add', methods=['POST', 'GET'])
@@ -141,20 +243,44 @@ def seed_events_from_file(filename=EVENTS_FILE):
     except TimeGhostError as err:
         return render_template('error.html', err=err), 404
 
+# Bulk-add events from an uploaded CSV
+@app.route('/upload', methods=['POST', 'GET'])
+def upload_events_server():
+    """
+    Add the events in a (date, description) CSV, sent either as the 'file'
+    field of a form or as the raw request body, and return a per-row report
+    as JSON. GET draws the upload form.
+    """
+    if request.method == "GET":
+        return render_template('upload.html')
+
+    upload = request.files.get('file')
+    stream = upload.stream if upload else request.stream
+    report = EventUploader.upload(
+        stream,
+        approved=users.is_current_user_admin(),
+        created_by=users.get_current_user())
+    return json.dumps(report)
+
 @app.route('/events_json', methods=['POST', 'GET'])
 @app.route('/events_json/<middle_key_or_date>', methods=['POST', 'GET'])
 @app.route('/j', methods=['POST', 'GET'])
 @app.route('/j/<middle_key_or_date>', methods=['POST', 'GET'])
+@conditional
+@compressed
 def events_json_server(middle_key_or_date=None):
     """
     Either all events, or all events in the 'timeghost range' between than a
-    given middle event key/date and now.
+    given middle event key/date and today, from the event index.
     """
     if request.method == "POST":
         middle_key_or_date = request.form['middle_event_key']
-    events = Event.get_events_in_range(Event.now(),
+    # Not Event.now(): the response must stay the same all day, to match its
+    # once-a-day ETag
+    events = Event.get_events_in_range(Event.today(),
                                        middle_key_or_date,
-                                       sort_asc=False)
+                                       sort_asc=False,
+                                       index=EventIndex.get())
     events_in_dicts = [{'key': e.key.urlsafe(),
                         'description': e.description,
                         'date': "({0.year}-{0.month}-{0.day})".format(e.date),
@@ -163,6 +289,56 @@ def events_json_server(middle_key_or_date=None):
     json_events = json.dumps({'events': events_in_dicts})
     return json_events
 
+@app.route('/timeline/<middle_key_or_date>/<end_date_str>')
+@app.route('/timeline/<middle_key_or_date>/<start_date_str>/<end_date_str>')
+@conditional
+@compressed
+def timeline_json_server(middle_key_or_date, end_date_str, start_date_str=None):
+    """
+    The long_ago events that make a timeghost with a given middle event, for
+    "now" dates between start (default: today) and end, as JSON.
+    """
+    try:
+        middle = Event.get_from_key_or_date(middle_key_or_date)
+        if start_date_str is None:
+            # Not Event.now(): the response must stay the same all day, to
+            # match its once-a-day ETag
+            start = Event.today()
+        else:
+            start = Event.build(date_str=start_date_str)
+        end = Event.build(date_str=end_date_str)
+
+        timeline = TimeGhostFactory.timeline(middle, start, end)
+        return json.dumps({
+            'middle': {
+                'key': middle.short_url,
+                'description': middle.description,
+                'date': middle.date_ymd,
+            },
+            'start': start.date_ymd,
+            'end': end.date_ymd,
+            'events': timeline,
+        })
+    except TimeGhostError as err:
+        return render_template('error.html', err=err), 404
+
+@app.route('/leaderboard')
+@app.route('/leaderboard/<int:decade>')
+@conditional
+@compressed
+def leaderboard_json_server(decade=None):
+    """
+    Today's k (?k=, default 10) most surprising timeghosts, overall or for
+    middle events in one decade (e.g. /leaderboard/1990), as JSON.
+    """
+    k = request.args.get('k', TimeGhostLeaderboard.K, type=int)
+    timeghosts = TimeGhostLeaderboard.get(k, decade)
+    return json.dumps({
+        'date': Event.today().date_ymd,
+        'decade': decade,
+        'timeghosts': timeghosts,
+    })
+
 @app.route('/events')
 @app.route('/events/<middle_key_or_date>')
 def events_server(middle_key_or_date=None):
@@ -178,12 +354,10 @@ def events_server(middle_key_or_date=None):
 
 # All events, as a CSV
 @app.route('/file')
+@conditional
+@compressed
 def events_file_server():
-    si = StringIO.StringIO()
-    cw = csv.writer(si)
-    events = Event.get_earlier_than()
-    cw.writerows([(e.date, e.description) for e in events])
-    output = make_response(si.getvalue())
+    output = make_response(EventExport.get())
     output.headers["Content-Disposition"] = "attachment; filename=events.csv"
     output.headers["Content-type"] = "text/csv"
     return output
@@ -326,8 +500,15 @@ def permalink_server(middle_key_urlsafe, long_ago_key_urlsafe=None):
         return render_template('error.html', err=err), 404
 
 @app.route('/tweet')
+@compressed
 def timeghost_json():
-    """Generate a random Timeghost and return it as a JSON object"""
+    """
+    A random Timeghost as a JSON object, from today's pool if there is one.
+    """
+    tweets = TimeGhostTweets.get()
+    if tweets:
+        return random.choice(tweets)
+
     middle = Event.get_random(before=Event.now())
     timeghost = TimeGhostFactory.build(middle=middle)
     tries_left= 5
@@ -370,6 +551,43 @@ def fast_timeghost_server(middle_date_str=None, now_date_str=None):
         return render_template('error.html', err=err), 404
 
 
+# Run by cron.yaml
+@app.route('/tasks/daily')
+def daily_tasks_server():
+    report = JobRunner.run()
+    status = 500 if any(job['error'] for job in report) else 200
+    return json.dumps({'jobs': report}), status
+
+@app.route('/cachestats')
+def cache_stats_server():
+    """Single-flight counters for this instance and the catalog version, as JSON."""
+    return json.dumps({
+        'single_flight': single_flight.stats,
+        'event_cache_version': event_cache.version(),
+    })
+
+# Profiled requests
+@app.route('/admin/profiles')
+def profiles_server():
+    return render_template('profiles.html', profiles=RequestProfile.recent())
+
+@app.route('/admin/profiles/<int:profile_id>')
+def profile_server(profile_id):
+    """The pstats text for a profile, or ?raw=1 for a .prof file."""
+    request_profile = RequestProfile.get_by_id(profile_id)
+    if request_profile is None:
+        return render_template('error.html', err="No such profile"), 404
+
+    if request.args.get('raw') == '1':
+        output = make_response(request_profile.stats_raw)
+        output.headers["Content-Disposition"] = (
+            "attachment; filename=profile-{}.prof".format(profile_id))
+        output.headers["Content-type"] = "application/octet-stream"
+    else:
+        output = make_response(request_profile.stats_text)
+        output.headers["Content-type"] = "text/plain"
+    return output
+
 @app.errorhandler(404)
 def page_not_found(err):
     return render_template('error.html', err=err, info="Page Not Found"), 404
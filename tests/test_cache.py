@@ -0,0 +1,219 @@
+"""Tests for the shared event cache, run against LocalCache."""
+
+import threading
+import time
+import unittest
+
+from google.appengine.ext import ndb, testbed
+
+import Cache
+from Cache import EventCache, LocalCache, SingleFlight
+from Model import Event, EventIndex
+
+
+class DeadlineExceeded(BaseException):
+    """Like App Engine's request deadline, which isn't an Exception."""
+
+
+class SingleFlightTest(unittest.TestCase):
+
+    WAITERS = 4
+
+    def setUp(self):
+        self.single_flight = SingleFlight()
+        self.release = threading.Event()
+        self.calls = []
+        self.results = []
+
+    def fetch(self):
+        """The first call blocks until released, then runs self.first_call."""
+        self.calls.append(1)
+        if len(self.calls) == 1:
+            self.release.wait()
+            return self.first_call()
+        return 'again'
+
+    def call(self):
+        try:
+            self.results.append(self.single_flight.do('key', self.fetch))
+        except BaseException as err:
+            self.results.append(err)
+
+    def run_callers(self):
+        threads = [threading.Thread(target=self.call) for _ in range(self.WAITERS + 1)]
+        for thread in threads:
+            thread.start()
+        # Let the first caller's fetch finish once all the others are waiting
+        while self.single_flight.stats['coalesced'] < self.WAITERS:
+            time.sleep(0.001)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+
+    def test_concurrent_calls_share_one_fetch(self):
+        self.first_call = lambda: 'value'
+        self.run_callers()
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.results, ['value'] * (self.WAITERS + 1))
+
+    def test_concurrent_calls_share_an_exception(self):
+        error = ValueError("no such event")
+
+        def first_call():
+            raise error
+
+        self.first_call = first_call
+        self.run_callers()
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.results, [error] * (self.WAITERS + 1))
+
+    def test_waiters_retry_when_the_fetch_never_completes(self):
+        def first_call():
+            raise DeadlineExceeded()
+
+        self.first_call = first_call
+        self.run_callers()
+        # The waiters retry, so at least one more fetch ran, and none of them
+        # took the unfinished fetch's None for a result
+        self.assertGreater(len(self.calls), 1)
+        self.assertNotIn(None, self.results)
+        self.assertEqual(len([r for r in self.results if isinstance(r, DeadlineExceeded)]), 1)
+        self.assertEqual(self.results.count('again'), self.WAITERS)
+
+
+class CacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+        # Event's put hook writes through the module-level cache
+        self.cache = Cache.event_cache
+        self.saved_client = self.cache.client
+        self.cache.client = LocalCache()
+
+    def tearDown(self):
+        self.cache.client = self.saved_client
+        self.testbed.deactivate()
+
+
+class EventCacheTest(CacheTestCase):
+
+    def test_fetches_once_and_caches_none(self):
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            return None
+
+        self.assertIsNone(self.cache.get_or_fetch('short_url', 'nope', fetch))
+        self.assertIsNone(self.cache.get_or_fetch('short_url', 'nope', fetch))
+        self.assertEqual(len(calls), 1)
+
+    def test_put_writes_through_under_a_new_version(self):
+        version = self.cache.version()
+        event = Event.build(date_str='1999-10-15', description='release of Fight Club')
+        event.put()
+
+        self.assertEqual(self.cache.version(), version + 1)
+        self.assertEqual(self.cache.get('short_url', event.short_url),
+                         (True, event))
+
+    def test_write_batch_bumps_the_version_once(self):
+        version = self.cache.version()
+        events = [
+            Event.build(date_str=str(year), description='event {}'.format(year))
+            for year in range(1990, 2000)
+        ]
+        with self.cache.write_batch():
+            ndb.put_multi(events)
+
+        self.assertEqual(self.cache.version(), version + 1)
+        for event in events:
+            self.assertEqual(self.cache.get('key', event.key.urlsafe()), (True, event))
+
+    def test_unsettled_lookups_are_cached_briefly(self):
+        Event.build(date_str='1999', description='something').put()
+        self.assertFalse(self.cache.state().settled)
+
+        # However late in the settle window it was fetched, a lookup expires
+        # by the time the catalog settles
+        written_at = time.time() - EventCache.SETTLE_SECONDS + 1
+        self.cache.client.set(EventCache.WRITTEN_KEY, written_at)
+        self.cache.get_or_fetch('marker', 'earliest', lambda: 'stale?')
+        key = self.cache._key('marker', 'earliest')
+        expires = self.cache.client._data[key][0]
+        self.assertGreater(expires, 0)
+        self.assertLessEqual(expires, written_at + EventCache.SETTLE_SECONDS)
+
+        self.cache.client.set(EventCache.WRITTEN_KEY,
+                              time.time() - EventCache.SETTLE_SECONDS - 1)
+        self.assertTrue(self.cache.state().settled)
+
+
+class EventIndexCacheTest(CacheTestCase):
+
+    def setUp(self):
+        super(EventIndexCacheTest, self).setUp()
+        self.saved_shard_size = EventIndex.SHARD_SIZE
+        EventIndex.SHARD_SIZE = 3
+        EventIndex._instance_copy = (None, None)
+        events = [
+            Event.build(date_str=str(year), description='event {}'.format(year))
+            for year in range(1990, 2000)
+        ]
+        for event in events:
+            event.approved = True
+        ndb.put_multi(events)
+        # Settle the catalog, so that lookups are cached for the full timeout
+        self.cache.client.set(EventCache.WRITTEN_KEY,
+                              time.time() - EventCache.SETTLE_SECONDS - 1)
+
+    def tearDown(self):
+        EventIndex.SHARD_SIZE = self.saved_shard_size
+        EventIndex._instance_copy = (None, None)
+        super(EventIndexCacheTest, self).tearDown()
+
+    def test_index_is_shared_as_shards(self):
+        loaded = EventIndex.get()
+        version = self.cache.version()
+        self.assertEqual(self.cache.get('index', 'approved', version), (True, (4, True)))
+
+        # Another instance reads the shards back rather than querying
+        EventIndex._instance_copy = (None, None)
+        load = EventIndex.__dict__['load']
+        EventIndex.load = classmethod(lambda cls: self.fail("queried"))
+        try:
+            shared = EventIndex.get()
+        finally:
+            EventIndex.load = load
+        self.assertEqual(shared.rows(), loaded.rows())
+        self.assertEqual([e.key for e in shared.events],
+                         [e.key for e in loaded.events])
+
+    def test_index_from_the_settle_window_is_not_kept(self):
+        written_at = time.time() - EventCache.SETTLE_SECONDS + 1
+        self.cache.client.set(EventCache.WRITTEN_KEY, written_at)
+        EventIndex.get()
+        self.assertEqual(EventIndex._instance_copy, (None, None))
+
+        # Once settled, the shards from the window aren't used, even if
+        # memcache still has them
+        self.cache.client.set(EventCache.WRITTEN_KEY, written_at - 2)
+        version = self.cache.version()
+        self.assertIsNone(EventIndex._from_cache(version, True))
+        index = EventIndex.get()
+        self.assertEqual(EventIndex._instance_copy, (version, index))
+        self.assertEqual(self.cache.get('index', 'approved', version), (True, (4, True)))
+
+    def test_index_survives_a_failed_set(self):
+        self.cache.client.set_multi = lambda mapping, time=0: mapping.keys()
+        loaded = EventIndex.get()
+        self.assertEqual(self.cache.get('index', 'approved'), (False, None))
+        self.assertIs(EventIndex.get(), loaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
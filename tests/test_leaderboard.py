@@ -0,0 +1,67 @@
+"""Tests for TimeGhostLeaderboard, checked against a scan of every pair."""
+
+import datetime
+import unittest
+
+from google.appengine.ext import testbed
+
+from Controller import TimeGhostLeaderboard
+from Model import Event, EventIndex, TimeGhost
+
+DATES = [
+    '1865-04-14', '1903-12-17', '1929-10-29', '1945-08-06', '1955-11-05',
+    '1964-02-09', '1969-07-20', '1977-05-25', '1981-08-01', '1985-07-03',
+    '1989-11-09', '1991-08-06', '1995-08-24', '1997-06-26', '1999-10-15',
+    '2001-10-23', '2004-02-04', '2007-06-29', '2010-04-03', '2015-04-12',
+]
+
+
+def brute_force(events, now):
+    """The lowest valid ratio for each middle, by scoring every pair."""
+    best = {}
+    for middle in events:
+        if middle.date >= now.date:
+            continue
+        for long_ago in events:
+            if long_ago.date >= middle.date:
+                continue
+            ratio = TimeGhost(now=now, middle=middle, long_ago=long_ago).ratio
+            if ratio > 1 and ratio < best.get(middle.description, float('inf')):
+                best[middle.description] = ratio
+    return best
+
+
+class TimeGhostLeaderboardTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.events = [Event.build(date_str=d, description="event " + d) for d in DATES]
+        self.index = EventIndex(self.events)
+        now = datetime.datetime(2020, 1, 1)
+        self.now = Event(date=now, description="today")
+
+    def tearDown(self):
+        self.testbed.deactivate()
+
+    def test_matches_brute_force(self):
+        expected = brute_force(self.events, self.now)
+        k = 5
+        best, by_decade = TimeGhostLeaderboard.build(self.index, self.now, k)
+
+        self.assertEqual(
+            [tg.ratio for tg in best],
+            sorted(expected.values())[:k])
+        for timeghost in best:
+            self.assertGreater(timeghost.ratio, 1)
+            self.assertEqual(timeghost.ratio, expected[timeghost.middle.description])
+
+        for decade, timeghosts in by_decade.items():
+            in_decade = sorted(
+                ratio for description, ratio in expected.items()
+                if int(description.split()[1][:4]) // 10 * 10 == decade)
+            self.assertEqual([tg.ratio for tg in timeghosts], in_decade[:k])
+
+
+if __name__ == '__main__':
+    unittest.main()
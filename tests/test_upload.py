@@ -0,0 +1,45 @@
+"""Tests for EventUploader's per-row report."""
+
+import StringIO
+import unittest
+
+from google.appengine.ext import ndb, testbed
+
+import Cache
+from Cache import LocalCache
+from Controller import EventUploader
+from Model import Event
+
+
+class EventUploaderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.testbed = testbed.Testbed()
+        self.testbed.activate()
+        self.testbed.init_datastore_v3_stub()
+        self.testbed.init_memcache_stub()
+        ndb.get_context().clear_cache()
+        self.saved_client = Cache.event_cache.client
+        Cache.event_cache.client = LocalCache()
+
+    def tearDown(self):
+        Cache.event_cache.client = self.saved_client
+        self.testbed.deactivate()
+
+    def test_bad_rows_are_reported_not_raised(self):
+        stream = StringIO.StringIO(
+            "1999-10-15,release of Fight Club\n"
+            "1999-10-16,contains a \x00 byte\n"
+            "1999-10-17,{}\n"
+            "not a date,something\n"
+            "2007-06-29,release of the iPhone\n".format('x' * 2000))
+        report = EventUploader.upload(stream, approved=True)
+
+        self.assertEqual(report['rows'], 5)
+        self.assertEqual(report['added'], 2)
+        self.assertEqual([e['line'] for e in report['errors']], [2, 3, 4])
+        self.assertEqual(len(Event.query().fetch()), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+"""
+Generate timeghosts offline, without a running app or datastore.
+
+Loads events.csv (or a /file export) into an in-memory EventIndex and builds
+timeghosts with the same TimeGhostFactory/TimeGhost logic the app uses,
+writing one JSON object per line. Needs the App Engine SDK on PYTHONPATH for
+the Model imports, but makes no API calls.
+
+    python timeghost_cli.py 1999-10-15 release-of-the-iphone
+    python timeghost_cli.py --birthday --count 5 --seed 1 1980-01-01
+    python timeghost_cli.py --events snapshot.csv --processes 8 - < dates.txt
+"""
+
+import argparse
+import json
+import multiprocessing
+import random
+import sys
+
+from Controller import EventSeeder, TimeGhostFactory
+from Model import Event, EventIndex, TimeGhostError
+
+# Set in each worker process by _init_worker
+_index = None
+_options = None
+
+
+def _init_worker(options):
+    global _index, _options
+    _options = options
+    _index = EventIndex(EventSeeder.read(options.events))
+
+
+def _middle_event(kod):
+    """An event from the index by short_url, or a new Event for a date."""
+    event = _index.find(kod)
+    if event is not None:
+        return event
+    description = "Your birthday" if _options.birthday else None
+    return Event.build(date_str=kod, description=description)
+
+
+def _as_dict(timeghost):
+    return dict(
+        now=timeghost.now.date_ymd,
+        middle=timeghost.middle.legendstr,
+        long_ago=timeghost.long_ago.legendstr,
+        factoid=timeghost.factoid,
+        verbose=timeghost.verbose,
+        permalink=timeghost.permalink_fully_qualified,
+        true_since=timeghost.true_since.date().isoformat(),
+        ratio=timeghost.ratio,
+    )
+
+
+def generate(kod):
+    """Return the JSON lines for one middle key-or-date."""
+    if _options.seed is not None:
+        random.seed("{}:{}".format(_options.seed, kod))
+
+    if _options.now is None:
+        now = Event.today()
+    else:
+        now = Event.build(date_str=_options.now, description="today")
+
+    lines = []
+    try:
+        middle = _middle_event(kod)
+        for _ in range(_options.count):
+            timeghost = TimeGhostFactory.build(
+                now=now, middle=middle, get_earliest=_options.worst, index=_index)
+            if _options.birthday:
+                timeghost.display_prefix = ""
+            lines.append(json.dumps(_as_dict(timeghost)))
+    except TimeGhostError as err:
+        lines.append(json.dumps(dict(middle=kod, error=str(err))))
+    return lines
+
+
+def _middles(options):
+    for kod in options.middles:
+        if kod == '-':
+            for line in sys.stdin:
+                if line.strip():
+                    yield line.strip()
+        else:
+            yield kod
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('middles', nargs='+', metavar='MIDDLE',
+                        help="middle event dates or short_urls; '-' reads them from stdin")
+    parser.add_argument('--events', help="CSV of date,description rows (default: events.csv)")
+    parser.add_argument('--now', help="date to use as now (default: today)")
+    parser.add_argument('--birthday', action='store_true',
+                        help="treat middle dates as birthdays")
+    parser.add_argument('--worst', action='store_true',
+                        help="use the earliest long_ago event, as /sw does")
+    parser.add_argument('--count', type=int, default=1,
+                        help="timeghosts per middle event")
+    parser.add_argument('--seed', help="random seed, for reproducible output")
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count())
+    options = parser.parse_args(argv)
+
+    middles = _middles(options)
+    if options.processes > 1:
+        pool = multiprocessing.Pool(options.processes, _init_worker, (options,))
+        results = pool.imap(generate, middles, chunksize=16)
+    else:
+        pool = None
+        _init_worker(options)
+        results = (generate(kod) for kod in middles)
+
+    try:
+        for lines in results:
+            for line in lines:
+                sys.stdout.write(line + "\n")
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+
+if __name__ == '__main__':
+    main()